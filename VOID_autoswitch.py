@@ -1,145 +1,452 @@
 # void_autoswitch.py
 # Switch default playback device when CORSAIR VOID v2 links/unlinks.
-# Requirements: pip install pywinusb ; SoundVolumeView.exe available.
+# Requirements: pip install pywinusb comtypes ; SoundVolumeView.exe as fallback.
 
-import time, threading, subprocess, os, sys
+import time, threading, subprocess, os, sys, queue, argparse
+import ctypes
+from ctypes import wintypes
+from ctypes import POINTER, Structure, c_ushort, c_uint, c_wchar_p, c_void_p
 import pywinusb.hid as hid
 
+# Join the MTA so the cached COM objects can be used from the HID callback
+# and watcher threads, not just the one that created them.
+sys.coinit_flags = 0
+try:
+  import comtypes
+  from comtypes import GUID, HRESULT, IUnknown, COMMETHOD, STDMETHOD, COMError
+except ImportError:
+  comtypes = None
+  COMError = OSError
+
 # ---- CONFIG ----
 VID, PID = 0x1B1C, 0x2A08
 SOUNDVOLUMEVIEW = os.path.join(os.path.dirname(__file__), "SoundVolumeView.exe")
 HEADSET_DEVICE_NAME = "CORSAIR VOID WIRELESS v2 Gaming Headset"
 SPEAKERS_DEVICE_NAME = "Realtek(R) Audio"
+REPORT_IDS = {0x01, 0x03}    # heartbeat and power-event input reports
 
-CHECK_INTERVAL = 0.1         # seconds
-DEBOUNCE_APPLY = 0.5         # min seconds between switch attempts
+DEBUG = bool(os.environ.get("VOID_DEBUG"))  # log every raw HID report
 
 # ---- STATE ----
-lock = threading.Lock()
+lock = threading.Lock()       # guards sm
+wake = threading.Event()      # set on a state transition; watcher() applies it
 devices = []
+log_q = queue.Queue(maxsize=1024)
+sm = None                     # VoidStateMachine, created in main()
 
-last_rx = 0.0
-last_online_hb = 0.0
-last_offline_hb = 0.0
-last_apply = 0.0
+policy = None                # IPolicyConfig, None -> use SoundVolumeView.exe
+enumerator = None            # IMMDeviceEnumerator
+endpoints = {}               # friendly name -> endpoint id
+iface_endpoints = {}         # interface name -> [endpoint id, ...]
 
-state = "UNKNOWN"
-desired = "UNKNOWN"
+# ---- LOGGING ----
+# Console writes happen on their own thread so the HID callback never blocks on stdio.
+def log(msg: str):
+  try:
+    log_q.put_nowait(msg)
+  except queue.Full:
+    pass
 
-def set_default_playback(name: str):
-  global last_apply
-  if not os.path.isfile(SOUNDVOLUMEVIEW):
-    print(f"[ERR] SoundVolumeView.exe not found at: {SOUNDVOLUMEVIEW}", flush=True)
-    return
-  now = time.time()
-  if (now - last_apply) < DEBOUNCE_APPLY:
-    return
+def logger():
+  while True:
+    msg = log_q.get()
+    try:
+      print(msg, flush=True)
+    except Exception:
+      pass  # e.g. unencodable text or a closed pipe; keep logging
+    finally:
+      log_q.task_done()
+
+def flush_log():
+  # Wait for queued lines, e.g. startup warnings before a fatal exit
+  log_q.join()
+
+# ---- CORE AUDIO (COM) ----
+eRender = 0
+eConsole, eMultimedia, eCommunications = 0, 1, 2
+DEVICE_STATE_ACTIVE = 0x1
+STGM_READ = 0
+VT_LPWSTR = 31
+
+class PROPERTYKEY(Structure):
+  _fields_ = [("fmtid", GUID if comtypes else c_void_p), ("pid", c_uint)]
+
+class PROPVARIANT(Structure):
+  _fields_ = [("vt", c_ushort), ("r1", c_ushort), ("r2", c_ushort), ("r3", c_ushort),
+              ("pwszVal", c_wchar_p), ("pad", c_void_p)]
+
+if comtypes:
+  # "Speakers (Realtek(R) Audio)" and "Realtek(R) Audio" respectively
+  PKEY_Device_FriendlyName = PROPERTYKEY(GUID("{a45c254e-df1c-4efd-8020-67d146a850e0}"), 14)
+  PKEY_DeviceInterface_FriendlyName = PROPERTYKEY(GUID("{026e516e-b814-414b-83cd-856d6fef4822}"), 2)
+
+  CLSID_MMDeviceEnumerator = GUID("{BCDE0395-E52F-467C-8E3D-C4579291692E}")
+  CLSID_PolicyConfigClient = GUID("{870af99c-171d-4f9e-af0d-e63df40c2bc9}")
+
+  class IPropertyStore(IUnknown):
+    _iid_ = GUID("{886d8eeb-8cf2-4446-8d02-cdba1dbdcf99}")
+    _methods_ = [
+      STDMETHOD(HRESULT, "GetCount", [POINTER(c_uint)]),
+      STDMETHOD(HRESULT, "GetAt", [c_uint, POINTER(PROPERTYKEY)]),
+      STDMETHOD(HRESULT, "GetValue", [POINTER(PROPERTYKEY), POINTER(PROPVARIANT)]),
+      STDMETHOD(HRESULT, "SetValue", [POINTER(PROPERTYKEY), POINTER(PROPVARIANT)]),
+      STDMETHOD(HRESULT, "Commit", []),
+    ]
+
+  class IMMDevice(IUnknown):
+    _iid_ = GUID("{D666063F-1587-4E43-81F1-B948E807363F}")
+    _methods_ = [
+      STDMETHOD(HRESULT, "Activate", [POINTER(GUID), c_uint, c_void_p, POINTER(c_void_p)]),
+      COMMETHOD([], HRESULT, "OpenPropertyStore",
+                (["in"], c_uint, "stgmAccess"),
+                (["out"], POINTER(POINTER(IPropertyStore)), "ppProperties")),
+      COMMETHOD([], HRESULT, "GetId", (["out"], POINTER(c_void_p), "ppstrId")),
+      COMMETHOD([], HRESULT, "GetState", (["out"], POINTER(c_uint), "pdwState")),
+    ]
+
+  class IMMDeviceCollection(IUnknown):
+    _iid_ = GUID("{0BD7A1BE-7A1A-44DB-8397-CC5392387B5E}")
+    _methods_ = [
+      COMMETHOD([], HRESULT, "GetCount", (["out"], POINTER(c_uint), "pcDevices")),
+      COMMETHOD([], HRESULT, "Item",
+                (["in"], c_uint, "nDevice"),
+                (["out"], POINTER(POINTER(IMMDevice)), "ppDevice")),
+    ]
+
+  class IMMDeviceEnumerator(IUnknown):
+    _iid_ = GUID("{A95664D2-9614-4F35-A746-DE8DB63617E6}")
+    _methods_ = [
+      COMMETHOD([], HRESULT, "EnumAudioEndpoints",
+                (["in"], c_uint, "dataFlow"),
+                (["in"], c_uint, "dwStateMask"),
+                (["out"], POINTER(POINTER(IMMDeviceCollection)), "ppDevices")),
+      COMMETHOD([], HRESULT, "GetDefaultAudioEndpoint",
+                (["in"], c_uint, "dataFlow"),
+                (["in"], c_uint, "role"),
+                (["out"], POINTER(POINTER(IMMDevice)), "ppEndpoint")),
+      STDMETHOD(HRESULT, "GetDevice", [c_wchar_p, POINTER(c_void_p)]),
+      STDMETHOD(HRESULT, "RegisterEndpointNotificationCallback", [c_void_p]),
+      STDMETHOD(HRESULT, "UnregisterEndpointNotificationCallback", [c_void_p]),
+    ]
+
+  # Undocumented; this is the interface SoundVolumeView wraps for /SetDefault
+  class IPolicyConfig(IUnknown):
+    _iid_ = GUID("{f8679f50-850a-41cf-9c72-430f290290c8}")
+    _methods_ = [
+      STDMETHOD(HRESULT, "GetMixFormat", [c_wchar_p, c_void_p]),
+      STDMETHOD(HRESULT, "GetDeviceFormat", [c_wchar_p, ctypes.c_int, c_void_p]),
+      STDMETHOD(HRESULT, "ResetDeviceFormat", [c_wchar_p]),
+      STDMETHOD(HRESULT, "SetDeviceFormat", [c_wchar_p, c_void_p, c_void_p]),
+      STDMETHOD(HRESULT, "GetProcessingPeriod", [c_wchar_p, ctypes.c_int, c_void_p, c_void_p]),
+      STDMETHOD(HRESULT, "SetProcessingPeriod", [c_wchar_p, c_void_p]),
+      STDMETHOD(HRESULT, "GetShareMode", [c_wchar_p, c_void_p]),
+      STDMETHOD(HRESULT, "SetShareMode", [c_wchar_p, c_void_p]),
+      STDMETHOD(HRESULT, "GetPropertyValue", [c_wchar_p, POINTER(PROPERTYKEY), POINTER(PROPVARIANT)]),
+      STDMETHOD(HRESULT, "SetPropertyValue", [c_wchar_p, POINTER(PROPERTYKEY), POINTER(PROPVARIANT)]),
+      STDMETHOD(HRESULT, "SetDefaultEndpoint", [c_wchar_p, c_uint]),
+      STDMETHOD(HRESULT, "SetEndpointVisibility", [c_wchar_p, ctypes.c_int]),
+    ]
+
+def device_id(dev) -> str:
+  p = dev.GetId()
+  try:
+    return ctypes.wstring_at(p)
+  finally:
+    ctypes.windll.ole32.CoTaskMemFree(ctypes.c_void_p(p))
+
+def device_prop(store, key) -> str:
+  pv = PROPVARIANT()
+  store.GetValue(ctypes.byref(key), ctypes.byref(pv))
   try:
-    subprocess.run([SOUNDVOLUMEVIEW, "/SetDefault", name, "1"],
-                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    subprocess.run([SOUNDVOLUMEVIEW, "/SetDefault", name, "2"],
-                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    last_apply = now
-    print(f"[OK] Default playback set to: {name}", flush=True)
-  except subprocess.CalledProcessError as e:
-    print(f"[ERR] Failed to set default device to '{name}': {e}", flush=True)
-
-def apply_state(new_state: str, reason: str):
-  global state
-  if new_state == state:
+    return pv.pwszVal if pv.vt == VT_LPWSTR else ""
+  finally:
+    ctypes.windll.ole32.PropVariantClear(ctypes.byref(pv))
+
+def enum_endpoints():
+  # Index each active render endpoint under both its full and interface
+  # name, matching what SoundVolumeView accepts for /SetDefault. Several
+  # endpoints can share an interface name (Speakers, Digital Output, ...).
+  endpoints.clear()
+  iface_endpoints.clear()
+  coll = enumerator.EnumAudioEndpoints(eRender, DEVICE_STATE_ACTIVE)
+  for i in range(coll.GetCount()):
+    dev = coll.Item(i)
+    store = dev.OpenPropertyStore(STGM_READ)
+    eid = device_id(dev)
+    name = device_prop(store, PKEY_Device_FriendlyName)
+    if name:
+      endpoints[name] = eid
+    name = device_prop(store, PKEY_DeviceInterface_FriendlyName)
+    if name:
+      iface_endpoints.setdefault(name, []).append(eid)
+
+def find_endpoint(name: str):
+  # Exact friendly name first; the interface name only if it is unambiguous
+  if name in endpoints:
+    return endpoints[name]
+  ids = iface_endpoints.get(name)
+  if not ids:
+    return None
+  if len(ids) > 1:
+    raise LookupError(f"'{name}' matches {len(ids)} playback endpoints; "
+                      f"use the full name, one of: "
+                      + ", ".join(n for n, e in endpoints.items() if e in ids))
+  return ids[0]
+
+def init_audio():
+  global policy, enumerator
+  if comtypes is None:
+    log("[WARN] comtypes not installed, falling back to SoundVolumeView.exe")
     return
-  state = new_state
-  ts = time.time()
-  print(f"{ts:.3f} STATE -> {state} ({reason})", flush=True)
-  if state == "ONLINE":
+  try:
+    enumerator = comtypes.CoCreateInstance(CLSID_MMDeviceEnumerator,
+                                           interface=IMMDeviceEnumerator,
+                                           clsctx=comtypes.CLSCTX_ALL)
+    policy = comtypes.CoCreateInstance(CLSID_PolicyConfigClient,
+                                       interface=IPolicyConfig,
+                                       clsctx=comtypes.CLSCTX_ALL)
+    enum_endpoints()
+  except (OSError, COMError) as e:
+    enumerator = policy = None
+    log(f"[WARN] COM init failed, falling back to SoundVolumeView.exe: {e}")
+
+def default_endpoint(role: int) -> str:
+  try:
+    return device_id(enumerator.GetDefaultAudioEndpoint(eRender, role))
+  except COMError:
+    return ""  # no default render device at all
+
+def set_default_endpoint(name: str) -> bool:
+  eid = find_endpoint(name)
+  if eid is None:
+    # Headset endpoint only becomes active once the receiver is enumerated
+    enum_endpoints()
+    eid = find_endpoint(name)
+    if eid is None:
+      raise LookupError(f"no active playback endpoint named '{name}'")
+  # Every role, same as the SoundVolumeView "/SetDefault <name> all" fallback.
+  # Roles can differ (e.g. Communications set by hand), so check each one.
+  changed = False
+  for role in (eConsole, eMultimedia, eCommunications):
+    if eid != default_endpoint(role):
+      policy.SetDefaultEndpoint(eid, role)
+      changed = True
+  return changed
+
+def soundvolumeview(*args):
+  subprocess.run([SOUNDVOLUMEVIEW, *args],
+                 check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def set_default_soundvolumeview(name: str):
+  # One process for every role
+  soundvolumeview("/SetDefault", name, "all")
+
+def set_default_playback(name: str):
+  try:
+    if policy is not None:
+      if not set_default_endpoint(name):
+        log(f"[OK] Default playback already: {name}")
+        return
+    else:
+      set_default_soundvolumeview(name)
+    log(f"[OK] Default playback set to: {name}")
+  except (subprocess.CalledProcessError, LookupError, OSError, COMError) as e:
+    log(f"[ERR] Failed to set default device to '{name}': {e}")
+
+def sync_default():
+  # Only called from watcher(). Switches to whatever the state is *now*, so
+  # transitions that pile up while a switch is running collapse into one.
+  current = sm.state
+  if current == "ONLINE":
     set_default_playback(HEADSET_DEVICE_NAME)
-  elif state == "OFFLINE":
+  elif current == "OFFLINE":
     set_default_playback(SPEAKERS_DEVICE_NAME)
 
+# Known report prefixes -> event; POWER_* match on 6 bytes, HB_* on 3
+_EVT = {
+  bytes([1, 1, 6]): "HB_ONLINE",
+  bytes([1, 0, 18]): "HB_OFFLINE",
+  bytes([3, 0, 1, 54, 0, 2]): "POWER_ON",
+  bytes([3, 0, 1, 54, 0, 0]): "POWER_OFF",
+}
+
 def classify(data):
-  if not data:
-    return "OTHER"
-  rid = data[0]
-  if rid == 0x01:
-    if len(data) >= 3:
-      if data[1] == 1 and data[2] == 6:
-        return "HB_ONLINE"
-      if data[1] == 0 and data[2] == 18:
-        return "HB_OFFLINE"
-    return "HB_UNKNOWN"
-  if rid == 0x03:
-    if len(data) >= 6 and data[1] == 0 and data[2] == 1 and data[3] == 54 and data[4] == 0:
-      if data[5] == 2:
-        return "POWER_ON"
-      if data[5] == 0:
-        return "POWER_OFF"
-    return "POWER_OTHER"
-  return "OTHER"
+  # Only the longest known prefix is converted, not the whole 65-byte report
+  b = bytes(data[:6])
+  return (_EVT.get(b) or _EVT.get(b[:3])
+          or ("HB_UNKNOWN" if b[:1] == b"\x01"
+              else "POWER_OTHER" if b[:1] == b"\x03"
+              else "OTHER"))
+
+# ---- STATE MACHINE ----
+# Report events each policy reacts to -> (state, reason)
+POLICIES = {
+  "power": {
+    "POWER_ON": ("ONLINE", "power-on event"),
+    "POWER_OFF": ("OFFLINE", "power-off event"),
+  },
+  "heartbeat": {
+    "HB_ONLINE": ("ONLINE", "online heartbeat"),
+    "HB_OFFLINE": ("OFFLINE", "offline heartbeat"),
+  },
+}
+POLICIES["both"] = {**POLICIES["power"], **POLICIES["heartbeat"]}
+
+class VoidStateMachine:
+  # All methods are called with `lock` held and return True when the state
+  # changed, i.e. watcher() has to be woken to run sync_default().
+  __slots__ = ("events", "state")
+
+  def __init__(self, events):
+    self.events = events
+    self.state = "UNKNOWN"
+
+  def apply(self, new_state: str, reason: str) -> bool:
+    if new_state == self.state:
+      return False
+    self.state = new_state
+    ts = time.time()
+    log(f"{ts:.3f} STATE -> {self.state} ({reason})")
+    return True
+
+  def on_report(self, evt: str) -> bool:
+    return self.apply(*self.events[evt])
 
 def on_data(data):
-  global last_rx, last_online_hb, last_offline_hb, desired
-  now = time.time()
-  evt = classify(data)
+  # pywinusb wraps each report in a ReadOnlyList (a UserList); slicing that
+  # builds another wrapper, so classify the backing list directly.
+  evt = classify(data.data)
+  if DEBUG:
+    log(f"{evt}: {data}")
+  target = sm.events.get(evt)
+  if target is None:
+    return
+  if target[0] == sm.state:
+    # Steady state (e.g. the periodic online heartbeat): nothing to decide,
+    # so skip the lock; reading a single attribute is safe under the GIL
+    return
   with lock:
-    last_rx = now
-
-    if evt == "POWER_ON":
-      desired = "ONLINE"
-      apply_state("ONLINE", "power-on event")
-      return
-    if evt == "POWER_OFF":
-      desired = "OFFLINE"
-      apply_state("OFFLINE", "power-off event")
-      return
-
-    if evt == "HB_ONLINE":
-      last_online_hb = now
-      if desired != "ONLINE":
-        desired = "ONLINE"
-      if state != "ONLINE":
-        apply_state("ONLINE", "online heartbeat")
-      return
-
-    if evt == "HB_OFFLINE":
-      last_offline_hb = now
-      if desired != "OFFLINE":
-        desired = "OFFLINE"
-      if state != "OFFLINE":
-        apply_state("OFFLINE", "offline heartbeat")
-      return
+    changed = sm.on_report(evt)
+  # pywinusb calls us under a lock shared by every open HidDevice, so the
+  # switch itself (COM calls or SoundVolumeView.exe) is left to watcher().
+  if changed:
+    wake.set()
 
 def watcher():
   while True:
-    time.sleep(CHECK_INTERVAL)
-    with lock:
-      # Heartbeat reconciliation only
-      if desired != state:
-        if desired == "ONLINE" and last_online_hb > 0:
-          apply_state("ONLINE", "reconcile to desired online")
-        elif desired == "OFFLINE" and last_offline_hb > 0:
-          apply_state("OFFLINE", "reconcile to desired offline")
+    # No offline grace timeout in these policies, so block until a transition
+    wake.wait()
+    wake.clear()
+    sync_default()
 
 def open_devices():
+  opened = []
   flt = hid.HidDeviceFilter(vendor_id=VID, product_id=PID)
   devs = flt.get_devices()
   for d in devs:
     try:
       d.open()
+      # The receiver exposes several collections; only the one declaring the
+      # heartbeat/power report ids carries the stream we classify.
+      if not REPORT_IDS & {r.report_id for r in d.find_input_reports()}:
+        d.close()
+        continue
       d.set_raw_data_handler(on_data)
-      devices.append(d)
-      print(f"[OK] Listening on: {d.device_path}")
+      opened.append(d)
+      log(f"[OK] Listening on: {d.device_path}")
     except Exception as e:
-      print(f"[WARN] open failed: {e}")
+      try: d.close()
+      except: pass
+      log(f"[WARN] open failed: {e}")
+  return opened
+
+# ---- PNP ----
+# HID arrival/removal notifications. The receiver raises no report when it
+# is unplugged, so without this the headset would stay the default device.
+# Only heartbeat-driven policies react: a power-only policy would have no
+# report to bring the state back ONLINE after the receiver is replugged.
+class ReceiverPnP(hid.HidPnPWindowMixin):
+  # A replugged receiver usually gets its old device path back, so path
+  # existence (is_plugged) cannot tell the dead handles from live ones.
+  receiver_removed = False
+
+  def on_hid_pnp(self, hid_event=None):
+    global devices
+    if hid_event == "disconnected" and not self.receiver_removed \
+        and not any(d.is_plugged() for d in devices):
+      self.receiver_removed = True
+      log("[WARN] VOID receiver removed")
+      with lock:
+        changed = sm.apply("OFFLINE", "receiver removed")
+      if changed:
+        wake.set()
+    elif hid_event == "connected" and self.receiver_removed:
+      # Old handles are dead; heartbeats on the new ones decide the state.
+      # Rebind rather than mutate, main() may be iterating the old list.
+      old, devices = devices, []
+      for d in old:
+        try: d.close()
+        except: pass
+      devices = open_devices()
+      # Another device's arrival may come first; retry on the next one
+      if devices:
+        self.receiver_removed = False
+    # The mixin only reports status flips across *all* HID devices; reset it
+    # so an unrelated arrival cannot mask the receiver's.
+    self.current_status = "unknown"
+    return True
+
+def pnp_listener():
+  # Notifications are delivered as window messages, so this thread owns a
+  # hidden message-only window and pumps its queue.
+  user32 = ctypes.windll.user32
+  user32.CreateWindowExW.restype = wintypes.HWND
+  user32.CreateWindowExW.argtypes = [wintypes.DWORD, wintypes.LPCWSTR, wintypes.LPCWSTR,
+                                     wintypes.DWORD, ctypes.c_int, ctypes.c_int,
+                                     ctypes.c_int, ctypes.c_int, wintypes.HWND,
+                                     wintypes.HMENU, wintypes.HINSTANCE, wintypes.LPVOID]
+  HWND_MESSAGE = wintypes.HWND(-3)
+  hwnd = user32.CreateWindowExW(0, "STATIC", "VOID_autoswitch", 0, 0, 0, 0, 0,
+                                HWND_MESSAGE, None, None, None)
+  if not hwnd:
+    log(f"[WARN] PnP window creation failed: {ctypes.WinError()}")
+    return
+  try:
+    pnp = ReceiverPnP(hwnd)
+  except hid.HIDError as e:
+    log(f"[WARN] PnP notifications unavailable: {e}")
+    return
+  msg = wintypes.MSG()
+  while user32.GetMessageW(ctypes.byref(msg), None, 0, 0) > 0:
+    user32.TranslateMessage(ctypes.byref(msg))
+    user32.DispatchMessageW(ctypes.byref(msg))
+  pnp.unhook_wnd_proc()
 
 def main():
-  open_devices()
+  global sm, devices
+  ap = argparse.ArgumentParser(description="Switch default playback device when the VOID headset links/unlinks.")
+  ap.add_argument("--policy", choices=sorted(POLICIES), default="both",
+                  help="which receiver reports drive the switch (default: both)")
+  args = ap.parse_args()
+  sm = VoidStateMachine(POLICIES[args.policy])
+
+  threading.Thread(target=logger, daemon=True).start()
+  init_audio()
+  if policy is None and not os.path.isfile(SOUNDVOLUMEVIEW):
+    flush_log()
+    print(f"SoundVolumeView.exe not found at: {SOUNDVOLUMEVIEW}", file=sys.stderr)
+    sys.exit(1)
+  devices = open_devices()
   if not devices:
+    flush_log()
     print("VOID receiver not found. Plug it in and run again.", file=sys.stderr)
     sys.exit(1)
 
-  print("Listening for headset link/unlink. Ctrl+C to exit.")
+  log("Listening for headset link/unlink. Ctrl+C to exit.")
   t = threading.Thread(target=watcher, daemon=True)
   t.start()
+  if "HB_ONLINE" in sm.events:
+    threading.Thread(target=pnp_listener, daemon=True).start()
 
   try:
     while True:
@@ -150,6 +457,7 @@ def main():
     for d in devices:
       try: d.close()
       except: pass
+    flush_log()
 
 if __name__ == "__main__":
   main()